@@ -1,75 +1,177 @@
+import argparse
+import collections
 import datetime
+import functools
+import hashlib
+import json
+import mmap
+import os
 import pathlib
+import re
 import warnings
-
-from openai import OpenAI
-from pycubexr import CubexParser
-from pycubexr.classes import Region
-
-import tiktoken
-
-
-def _make_callpath_mapping(cnodes, enable_demangle_names=True) -> dict[str, int]:
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+
+# openai, pycubexr, tiktoken, diskcache and itanium_demangler are imported where they are first used,
+# so that importing this module or running --help stays cheap
+if TYPE_CHECKING:
+    from pycubexr.classes import Region
+
+
+# MPI calls whose cost does not depend on n, p or their arguments, answered without asking the LLM
+_CONSTANT_MPI_REGIONS = frozenset({
+    'MPI_Comm_rank',
+    'MPI_Comm_size',
+    'MPI_Comm_test_inter',
+    'MPI_Finalized',
+    'MPI_Get_count',
+    'MPI_Get_processor_name',
+    'MPI_Initialized',
+    'MPI_Query_thread',
+    'MPI_Type_size',
+    'MPI_Wtick',
+    'MPI_Wtime',
+})
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(name="o200k_base"):
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+
+@functools.lru_cache(maxsize=1024)
+def _count_tokens(snippet: str) -> int:
+    # ancestor regions are part of every descendant callpath, so most snippets are counted only once
+    return len(_get_encoding("o200k_base").encode(snippet))
+
+
+@functools.lru_cache(maxsize=None)
+def _demangle_name(name: str, enable_demangle_names: bool = True) -> str:
+    # the same function shows up under many callsites, so each mangled name is parsed only once
+    if enable_demangle_names:
+        from itanium_demangler import parse as demangle
+        try:
+            demangled = demangle(name)
+            if demangled:
+                name = str(demangled)
+        except NotImplementedError as e:
+            pass
+    return name.replace('->', '- >')
+
+
+@functools.lru_cache(maxsize=None)
+def _get_llm_cache(directory='.llm_cache'):
+    from diskcache import Cache
+    return Cache(directory)
+
+
+def _has_complexity(message: Optional[str]) -> bool:
+    # the answer is extracted from the tags, a reply without them is useless
+    return bool(message) and '</complexity>' in message.partition('<complexity>')[2]
+
+
+def _request_completion(api_client, model, messages, llm_cache=None, max_attempts=3) -> Optional[str]:
+    key = None
+    if llm_cache is not None:
+        key = hashlib.sha256(json.dumps([model, messages]).encode()).hexdigest()
+        message = llm_cache.get(key)
+        if _has_complexity(message):
+            return message
+
+    for _ in range(max_attempts):
+        chat_completion = api_client.chat.completions.create(
+            messages=messages, model=model
+        )
+
+        message = chat_completion.choices[0].message.content
+        if _has_complexity(message):
+            # only usable replies are cached, so a bad reply is retried on the next run
+            if llm_cache is not None:
+                llm_cache[key] = message
+            return message
+
+    warnings.warn(f"No <complexity> result in the reply after {max_attempts} attempts.", RuntimeWarning)
+    return None
+
+
+def _make_callpath_mapping(cnodes, enable_demangle_names=True) \
+        -> tuple[dict[str, int], dict[str, list[str]], dict[str, str]]:
     callpaths = {}
-
-    def demangle_name(name):
-        if enable_demangle_names:
-            from itanium_demangler import parse as demangle
-            try:
-                demangled = demangle(name)
-                if demangled:
-                    name = str(demangled)
-            except NotImplementedError as e:
-                pass
-        return name.replace('->', '- >')
-
-    def walk_tree(parent_cnode, parent_name):
-        for cnode in parent_cnode.get_children():
-            name = cnode.region.name
-            name = demangle_name(name)
-            path_name = '->'.join((parent_name, name))
-            callpaths[path_name] = cnode.id
-            walk_tree(cnode, path_name)
-
-    for root_cnode in cnodes:
-        name = root_cnode.region.name
-        name = demangle_name(name)
-        callpaths[name] = root_cnode.id
-        walk_tree(root_cnode, name)
-
-    return callpaths
-
-
-def get_source_code(region: Region, source_code_mapping) -> str:
+    children = {}
+    parent = {}
+
+    # iterative pre-order DFS, children are pushed reversed to keep the original visiting order
+    stack = [(root_cnode, (_demangle_name(root_cnode.region.name, enable_demangle_names),), None)
+             for root_cnode in reversed(cnodes)]
+    while stack:
+        cnode, parts, parent_path = stack.pop()
+        path = '->'.join(parts)
+        if parent_path is not None and path not in callpaths:
+            parent[path] = parent_path
+            children.setdefault(parent_path, []).append(path)
+        callpaths[path] = cnode.id
+        for child in reversed(cnode.get_children()):
+            stack.append((child, parts + (_demangle_name(child.region.name, enable_demangle_names),), path))
+
+    return callpaths, children, parent
+
+
+# '\r\n', a lone '\r' and '\n' all end a line, as they did with str.splitlines()
+_LINE_BREAK = re.compile(rb'\r\n?|\n')
+
+
+@functools.lru_cache(maxsize=128)
+def _line_index(path_str: str) -> tuple[Optional[mmap.mmap], tuple[tuple[int, int], ...]]:
+    # many regions of a callpath live in the same module, so each file is mapped once and
+    # indexed by the byte span of every line; only the requested region is ever decoded
+    with open(path_str, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None, ()
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    line_spans = []
+    start = 0
+    for line_break in _LINE_BREAK.finditer(source):
+        line_spans.append((start, line_break.start()))
+        start = line_break.end()
+    if start != len(source):
+        line_spans.append((start, len(source)))
+    return source, tuple(line_spans)
+
+
+def get_source_code(region: 'Region', source_code_mapping) -> str:
     module_path = region.mod
     if not module_path:
         raise ValueError(f"This call path does not have source information.")
     path = pathlib.Path(module_path)
-    module_source = None
-    if path.exists():
-        module_source = path.read_text()
-
-    for s, d in source_code_mapping.items():
-        path_str = str(path)
+    path_str = str(path)
+    module_path = path
+    # source_code_mapping is sorted by prefix length, so the first hit is the most specific one
+    for s, d in source_code_mapping:
         if path_str.startswith(s):
-            p = path_str.replace(s, d)
-            module_path = pathlib.Path(p)
-            if module_path.exists():
-                module_source = module_path.read_text()
-            else:
-                module_source = None
-                break
+            module_path = pathlib.Path(path_str.replace(s, d, 1))
+            break
+
+    module_source = None
+    if module_path.exists():
+        module_source, line_spans = _line_index(str(module_path))
 
     if not module_source:
         raise RuntimeError(f"Source code not found. The source file {module_path} does not exist.")
 
-    lines = module_source.splitlines()
-    relevant_lines = lines[region.begin - 1:region.end]
-    source_code = '\n'.join(relevant_lines)
-    return source_code
+    num_lines = len(line_spans)
+    first = min(max(region.begin - 1, 0), num_lines)
+    last = min(region.end, num_lines)
+    if last <= first:
+        return ''
+    source_code = module_source[line_spans[first][0]:line_spans[last - 1][1]].decode('utf-8', 'replace')
+    return source_code.replace('\r\n', '\n').replace('\r', '\n')
+
 
+def analyze_cube_file(filepath, source_code_mapping, use_cache=True, concurrency=8):
+    from openai import OpenAI
+    from pycubexr import CubexParser
 
-def analyze_cube_file(filepath, source_code_mapping):
     api_client = OpenAI(
         # defaults to os.environ.get("OPENAI_API_KEY")
         base_url='http://130.83.143.245:18000/v1/',
@@ -79,47 +181,70 @@ def analyze_cube_file(filepath, source_code_mapping):
     model = models.data[0].id
 
     tokens_for_code = 130000
-    tokenizer_enc = tiktoken.get_encoding("o200k_base")
+    llm_cache = _get_llm_cache() if use_cache else None
+
+    source_code_mapping = sorted(source_code_mapping.items(), key=lambda kv: len(kv[0]), reverse=True)
 
-    with CubexParser(str(filepath)) as parsed:
-        callpaths = _make_callpath_mapping(parsed.get_root_cnodes())
+    def resolve_complexity(messages):
+        if messages is None:
+            return 'O(1)'
+        message = _request_completion(api_client, model, messages, llm_cache)
+        if message is None:
+            return 'unresolved'
+        return message.split('<complexity>', maxsplit=1)[1].split('</complexity>')[0]
+
+    # the requests are network bound and independent, so overlap their latencies; prompts are
+    # submitted while the callpaths are walked and only a bounded window of them is kept alive
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, CubexParser(str(filepath)) as parsed:
+        callpaths, children, parent = _make_callpath_mapping(parsed.get_root_cnodes())
 
         for cp in callpaths:
             relevant_code_regions = []
             callpaths_to_ignore = []
 
             current_call_path = cp
-            while '->' in current_call_path:
+            while current_call_path in parent:
                 cnode_id = callpaths[current_call_path]
                 code_region = parsed.get_cnode(cnode_id).region
                 relevant_code_regions.append(code_region)
 
-                for ignore_cp in callpaths:
-                    if ignore_cp.startswith(current_call_path) and ignore_cp.count('->', len(current_call_path)) == 1:
-                        callpaths_to_ignore.append(ignore_cp.split('->', maxsplit=1)[1])
+                for ignore_cp in children.get(current_call_path, []):
+                    callpaths_to_ignore.append(ignore_cp.split('->', maxsplit=1)[1])
 
-                current_call_path = current_call_path.rsplit('->', maxsplit=1)[0]
+                current_call_path = parent[current_call_path]
 
             if not relevant_code_regions:
                 continue
 
-            relevant_source_code = ""
+            # relevant_code_regions[0] is the leaf of the callpath
+            leaf_region = relevant_code_regions[0]
+            if leaf_region.mod == 'MPI' and leaf_region.name in _CONSTANT_MPI_REGIONS:
+                pending.append((cp, executor.submit(resolve_complexity, None)))
+                continue
+
+            source_parts = []
+            running_tokens = 0
 
             try:
 
                 for region in reversed(relevant_code_regions):
                     if region.mod == 'MPI':
-                        relevant_source_code += "The source code for region " + region.name + " is vendor specific, assume a standard implementation.\n"
+                        snippet = "The source code for region " + region.name + " is vendor specific, assume a standard implementation.\n"
                     else:
                         source_snippet = get_source_code(region, source_code_mapping)
-                        relevant_source_code += source_snippet + '\n\n'
-                    if len(tokenizer_enc.encode(relevant_source_code)) > tokens_for_code:
+                        snippet = source_snippet + '\n\n'
+                    # count only the new snippet instead of re-encoding the whole buffer
+                    running_tokens += _count_tokens(snippet)
+                    source_parts.append(snippet)
+                    if running_tokens > tokens_for_code:
                         raise NotImplementedError("Token limit exceeded.")
 
 
             except RuntimeError as e:
                 warnings.warn(str(e), RuntimeWarning)
 
+            relevant_source_code = ''.join(source_parts)
             if not relevant_source_code:
                 continue
 
@@ -145,21 +270,27 @@ def analyze_cube_file(filepath, source_code_mapping):
             }
             ]
 
-            message = ""
-
-            while len(message) < 10:
-                chat_completion = api_client.chat.completions.create(
-                    messages=messages, model=model
-                )
+            pending.append((cp, executor.submit(resolve_complexity, messages)))
+            # results are printed in callpath order as the oldest requests finish
+            while len(pending) > 2 * concurrency:
+                done_cp, future = pending.popleft()
+                print(done_cp, ':', future.result())
 
-                message = chat_completion.choices[0].message.content
+        while pending:
+            done_cp, future = pending.popleft()
+            print(done_cp, ':', future.result())
 
-            complexity = message.split('<complexity>', maxsplit=1)[1].split('</complexity>')[0]
-
-            print(cp, ':', complexity)
+    # dropping the cached mappings closes them, otherwise the source files stay open (and locked
+    # on Windows) for the rest of the process
+    _line_index.cache_clear()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-cache', action='store_true', help="Do not reuse or store LLM responses in .llm_cache.")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of LLM requests in flight at once.")
+    args = parser.parse_args()
+
     source_code_mapping = {str(pathlib.Path('/work/home/ag27juro/gadget4-master')):
                                str(pathlib.Path(r'C:\Users\Alexander\Projects\test_big_apps\gadget\source\gadget4')),
                            str(pathlib.Path('BC_MPI_1733089303_831274.input.prep.opari.cpp')):
@@ -167,7 +298,7 @@ if __name__ == '__main__':
                                    r'C:\Users\Alexander\Downloads\case_1-20251126T100259Z-1-001\case_1\BC_MPI.cpp'))}
     analyze_cube_file(
         r"C:\Users\Alexander\Downloads\case_1-20251126T100259Z-1-001\case_1\measurements_swc_cube\BB.p128.n8000\profile.cubex",
-        source_code_mapping)
+        source_code_mapping, use_cache=not args.no_cache, concurrency=args.concurrency)
     # source_code_mapping = {str(pathlib.Path('/work/home/ag27juro/gadget4-master')):
     #                            str(pathlib.Path(r'C:\Users\Alexander\Projects\test_big_apps\gadget\source\gadget4'))}
     # analyze_cube_file(r"C:\Users\Alexander\Projects\test_big_apps\gadget\gdg.p96.g96.r1\profile.cubex",
@@ -3,12 +3,20 @@ import csv
 import random
 from collections import defaultdict
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import json
 
+import numpy as np
 import torch
-from datasets import load_dataset, concatenate_datasets
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from datasets import Dataset, load_dataset
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    LogitsProcessor,
+    LogitsProcessorList,
+)
+from transformers.utils import is_flash_attn_2_available
 
 try:
     from tqdm import tqdm
@@ -27,6 +35,9 @@ GENERIC_LABEL_RE = re.compile(
     re.IGNORECASE,
 )
 
+# "time complexity is", "the time complexity is", "complexity:", ...
+ANSWER_PREFIX_RE = re.compile(r"^(?:the\s+)?(?:time\s+)?complexity(?:\s+is|\s*:)\s*")
+
 # labels
 ALL_COMPLEXITY_LABELS = [
     "linear",
@@ -38,8 +49,42 @@ ALL_COMPLEXITY_LABELS = [
     "np",
 ]
 
+# mapping of compact big-O spellings to labels, built once instead of per prediction
+BIG_O_MAP = {
+    # constant
+    "1": "constant",
+    "n^0": "constant",
+    "n0": "constant",
+    "constant": "constant",
+    # linear
+    "n": "linear",
+    "linear": "linear",
+    # log n
+    "logn": "logn",
+    # n log n
+    "nlogn": "nlogn",
+    # quadratic
+    "n^2": "quadratic",
+    "n2": "quadratic",
+    "n**2": "quadratic",
+    "quadratic":  "quadratic",
+    # cubic
+    "n^3": "cubic",
+    "n3": "cubic",
+    "n**3": "cubic",
+    "cubic": "cubic",
+    # np (non-polynomial / exponential or worse)
+    "2^n": "np",
+    "2**n": "np",
+    "exp": "np",
+    "exponential": "np",
+    "n!": "np",
+    "factorial": "np",
+    "np": "np",
+}
+
 # direct hugging face download won't work cause the dataaset is saved in csv filees
-def load_tasty_dataset():
+def load_tasty_dataset(cache_dir: Optional[str] = None) -> List[Dataset]:
     cpp_url = (
         "https://huggingface.co/datasets/Banana-Leopard/TASTY/"
         "resolve/main/cpp_data_clean.csv"
@@ -49,36 +94,38 @@ def load_tasty_dataset():
         "resolve/main/python_data_clean.csv"
     )
 
-    ds_cpp = load_dataset("csv", data_files=cpp_url)["train"]
-    ds_py = load_dataset("csv", data_files=py_url)["train"]
-
-    ds = concatenate_datasets([ds_cpp, ds_py])
-
+    # the two CSVs stay separate Arrow tables, converted once in cache_dir and memory-mapped on
+    # later runs; only the columns we use are selected and nothing is concatenated or rewritten
     keep_cols = ["code", "time_complexity"]
-    drop_cols = [c for c in ds.column_names if c not in keep_cols]
-    if drop_cols:
-        ds = ds.remove_columns(drop_cols)
-
-    return ds
+    return [
+        load_dataset("csv", data_files=url, split="train", cache_dir=cache_dir).select_columns(keep_cols)
+        for url in (cpp_url, py_url)
+    ]
 
 
-def balanced_subsample(ds, n_per_class: int = 20, seed: int = 42):
+def balanced_subsample(datasets: List[Dataset], n_per_class: int = 20, seed: int = 42) -> List[Dict[str, str]]:
     rng = random.Random(seed)
-    labels = ds["time_complexity"]
-
-    idx_by_label: Dict[str, List[int]] = defaultdict(list)
-    for idx, lbl in enumerate(labels):
-        idx_by_label[lbl].append(idx)
-
-    selected_indices: List[int] = []
-    for lbl, idxs in idx_by_label.items():
-        idxs_copy = list(idxs)
-        rng.shuffle(idxs_copy)
-        take = min(n_per_class, len(idxs_copy))
-        selected_indices.extend(idxs_copy[:take])
 
-    selected_indices = sorted(selected_indices)
-    subset = ds.select(selected_indices)
+    # reservoir sampling (Algorithm R) per label over the label column, rows are keyed by
+    # (file, row index): a single pass that only ever holds n_per_class keys per label
+    reservoirs: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    seen: Dict[str, int] = defaultdict(int)
+    for file_idx, ds in enumerate(datasets):
+        for row_idx, lbl in enumerate(ds["time_complexity"]):
+            reservoir = reservoirs[lbl]
+            seen[lbl] += 1
+            if len(reservoir) < n_per_class:
+                reservoir.append((file_idx, row_idx))
+            else:
+                j = rng.randrange(seen[lbl])
+                if j < n_per_class:
+                    reservoir[j] = (file_idx, row_idx)
+
+    selected_indices = sorted(key for reservoir in reservoirs.values() for key in reservoir)
+    subset: List[Dict[str, str]] = []
+    for file_idx, ds in enumerate(datasets):
+        # only the sampled rows are converted to Python
+        subset.extend(ds.select([row_idx for f, row_idx in selected_indices if f == file_idx]))
 
     return subset
 
@@ -111,6 +158,23 @@ def build_messages(code: str, label_options: List[str]) -> List[Dict[str, str]]:
     ]
     return messages
 
+
+# stands in for the code snippet when rendering the chat template once
+CODE_PLACEHOLDER = "<<<CODE_SNIPPET>>>"
+
+
+def build_prompt_token_ids(tokenizer, codes: List[str], label_options: List[str]) -> List[List[int]]:
+    # the system prompt and chat scaffolding are identical for every example, so the template
+    # is rendered once; the full prompts are tokenized as whole strings in one batched call so
+    # merges across the code boundaries (e.g. "}\n", "\n\n") match the canonical tokenization
+    template = tokenizer.apply_chat_template(
+        build_messages(CODE_PLACEHOLDER, label_options),
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+    prefix_text, suffix_text = template.split(CODE_PLACEHOLDER)
+    return tokenizer([prefix_text + code + suffix_text for code in codes], add_special_tokens=False)["input_ids"]
+
 # def normalize_prediction(raw_text: str, allowed_labels: List[str]) -> Optional[str]:
 #     if not raw_text:
 #         return None
@@ -186,70 +250,17 @@ def normalize_prediction(raw_text: str, allowed_labels: List[str]) -> Optional[s
     if text in allowed_set:
         return text
 
-    for prefix in [
-        "time complexity is",
-        "time complexity:",
-        "the time complexity is",
-        "complexity:",
-        "complexity is",
-    ]:
-        if text.startswith(prefix):
-            text = text[len(prefix) :].strip()
-
-    if text.endswith("."):
-        text = text[:-1].strip()
-
-    compact = text.replace(" ", "")
+    compact = ANSWER_PREFIX_RE.sub("", text).removesuffix(".").replace(" ", "")
 
     if compact.startswith("o(") and compact.endswith(")"):
         compact = compact[2:-1]
 
-    compact = (
-        compact.replace("log(n)", "logn")
-        .replace("logn", "logn")
-        .replace("nlog(n)", "nlogn")
-        .replace("nlogn", "nlogn")
-    )
+    # "nlog(n)" -> "nlogn" is covered by the same pass
+    compact = compact.replace("log(n)", "logn")
 
-    if compact in allowed_set:
-        return compact
-
-    # mapping
-    big_o_map = {
-        # constant
-        "1": "constant",
-        "n^0": "constant",
-        "n0": "constant",
-        "constant": "constant",
-        # linear
-        "n": "linear",
-        "linear": "linear",
-        # log n
-        "logn": "logn",
-        # n log n
-        "nlogn": "nlogn",
-        # quadratic
-        "n^2": "quadratic",
-        "n2": "quadratic",
-        "n**2": "quadratic",
-        "quadratic":  "quadratic",
-        # cubic
-        "n^3": "cubic",
-        "n3": "cubic",
-        "n**3": "cubic",  
-        "cubic": "cubic",  
-        # np (non-polynomial / exponential or worse)
-        "2^n": "np",
-        "2**n": "np",
-        "exp": "np",
-        "exponential": "np",
-        "n!": "np",
-        "factorial": "np",
-        "np": "np",
-    }
-
-    if compact in big_o_map and big_o_map[compact] in allowed_set:
-        return big_o_map[compact]
+    label = compact if compact in allowed_set else BIG_O_MAP.get(compact)
+    if label in allowed_set:
+        return label
 
     for lbl in allowed_labels:
         if lbl in compact:
@@ -258,38 +269,186 @@ def normalize_prediction(raw_text: str, allowed_labels: List[str]) -> Optional[s
     return None
 
 
-def load_qwen(model_name: str = "Qwen/Qwen2.5-1.5B-Instruct", cache_dir: str = "/araf/time_complexity"):
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModelForCausalLM.from_pretrained(
+class LabelChoiceLogitsProcessor(LogitsProcessor):
+    """Only allows continuations that spell one of the labels, followed by EOS."""
+
+    def __init__(self, tokenizer, labels: List[str], prompt_length: int):
+        self.label_ids = [tokenizer.encode(lbl, add_special_tokens=False) for lbl in labels]
+        self.eos_token_id = tokenizer.eos_token_id
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        mask = torch.full_like(scores, float("-inf"))
+        for row, ids in enumerate(input_ids):
+            generated = ids[self.prompt_length :].tolist()
+            step = len(generated)
+            allowed = {
+                seq[step] if len(seq) > step else self.eos_token_id
+                for seq in self.label_ids
+                if seq[:step] == generated
+            }
+            mask[row, list(allowed or {self.eos_token_id})] = 0
+        return scores + mask
+
+
+def _from_pretrained(cls, model_name: str, cache_dir: Optional[str], **kwargs):
+    # reuse the copy in cache_dir without contacting the hub, download only if it is missing
+    try:
+        return cls.from_pretrained(model_name, cache_dir=cache_dir, local_files_only=True, **kwargs)
+    except OSError:
+        return cls.from_pretrained(model_name, cache_dir=cache_dir, **kwargs)
+
+
+def load_qwen(
+    model_name: str = "Qwen/Qwen2.5-1.5B-Instruct",
+    cache_dir: Optional[str] = None,
+    quantization: str = "none",
+    compile_model: bool = False,
+):
+    tokenizer = _from_pretrained(AutoTokenizer, model_name, cache_dir, use_fast=True)
+    # prompts are batched, left padding keeps every row's new tokens right after the prompt
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # smaller weights mean less memory traffic per decoded token
+    if quantization == "nf4":
+        quant_kwargs = {
+            "quantization_config": BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+        }
+    elif quantization == "int8":
+        quant_kwargs = {"quantization_config": BitsAndBytesConfig(load_in_8bit=True)}
+    else:
+        quant_kwargs = {}
+    model = _from_pretrained(
+        AutoModelForCausalLM,
         model_name,
-        torch_dtype="auto",
-        device_map="auto"
+        cache_dir,
+        torch_dtype=torch.bfloat16,
+        device_map="auto",
+        # flash-attn is an optional install, fall back to PyTorch SDPA without it
+        attn_implementation="flash_attention_2" if is_flash_attn_2_available() else "sdpa",
+        **quant_kwargs,
     )
     model.eval()
+    if compile_model:
+        # a static KV cache keeps decode shapes fixed, so the captured CUDA graph is replayed every step
+        model.generation_config.cache_implementation = "static"
+        # prompt lengths and batch sizes still vary between generate calls; with static shapes each
+        # new one recompiles until dynamo hits its recompile limit and falls back to eager
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
     return tokenizer, model
 
 
-def predict_label_for_example(tokenizer, model, code: str, label_options: List[str], max_new_tokens: int = 512) -> str:
-    messages = build_messages(code, label_options)
-    chat_text = tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True,
+def predict_labels_batched(
+    tokenizer,
+    model,
+    codes: List[str],
+    label_options: List[str],
+    batch_size: int = 32,
+    max_new_tokens: int = 16,
+    constrained: bool = True,
+    pad_to_multiple_of: Optional[int] = None,
+    max_batch_tokens: int = 8192,
+) -> List[str]:
+    prompt_ids = build_prompt_token_ids(tokenizer, codes, label_options)
+
+    # group prompts of similar length to keep padding small, long prompts get smaller batches
+    order = sorted(range(len(prompt_ids)), key=lambda i: len(prompt_ids[i]))
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    for i in order:
+        # sorted by length, so prompt i is the longest in its batch
+        if batch and (len(batch) >= batch_size or (len(batch) + 1) * len(prompt_ids[i]) > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+
+    preds: List[str] = [""] * len(prompt_ids)
+
+    for batch in tqdm(batches):
+        # padding prompts to a few bucket lengths avoids recompiling a compiled model for every new length
+        inputs = tokenizer.pad(
+            {"input_ids": [prompt_ids[i] for i in batch]},
+            return_tensors="pt",
+            padding=True,
+            pad_to_multiple_of=pad_to_multiple_of,
+        ).to(model.device)
+        prompt_length = inputs.input_ids.shape[1]
+
+        logits_processor = LogitsProcessorList()
+        if constrained:
+            logits_processor.append(
+                LabelChoiceLogitsProcessor(tokenizer, label_options, prompt_length)
+            )
+
+        # one generate call per batch, weights are read once per step for all rows
+        with torch.no_grad():
+            generated_ids = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False, 
+                # the answer is a single label, stop as soon as the model starts a new line
+                stop_strings=["\n"],
+                tokenizer=tokenizer,
+                logits_processor=logits_processor,
+                pad_token_id=tokenizer.pad_token_id,
+            )
+
+        new_tokens = generated_ids[:, prompt_length:]
+        for i, out in zip(batch, tokenizer.batch_decode(new_tokens, skip_special_tokens=True)):
+            preds[i] = out.strip()
+
+    return preds
+
+
+# vLLM is optional, it is only imported when --backend vllm is requested
+def load_qwen_vllm(
+    model_name: str = "Qwen/Qwen2.5-1.5B-Instruct", cache_dir: Optional[str] = None, quantization: str = "none"
+):
+    from vllm import LLM
+
+    llm = LLM(
+        model=model_name,
+        download_dir=cache_dir,
+        dtype="bfloat16",
+        gpu_memory_utilization=0.9,
+        # every prompt starts with the same system prompt and chat scaffolding, reuse its KV cache
+        enable_prefix_caching=True,
+        # vLLM quantizes with bitsandbytes to 4 bit on load
+        quantization="bitsandbytes" if quantization == "nf4" else None,
     )
+    tokenizer = llm.get_tokenizer()
+    return tokenizer, llm
 
-    inputs = tokenizer([chat_text], return_tensors="pt").to(model.device)
 
-    with torch.no_grad():
-        generated_ids = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            do_sample=False, 
-        )
+def predict_labels_vllm(
+    tokenizer, llm, codes: List[str], label_options: List[str], max_new_tokens: int = 16, constrained: bool = True
+) -> List[str]:
+    from vllm import SamplingParams
+    from vllm.sampling_params import GuidedDecodingParams
+
+    prompts = [
+        {"prompt_token_ids": ids} for ids in build_prompt_token_ids(tokenizer, codes, label_options)
+    ]
 
-    new_tokens = generated_ids[:, inputs.input_ids.shape[1] :]
-    out = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)[0]
+    sampling_params = SamplingParams(
+        temperature=0.0,
+        max_tokens=max_new_tokens,
+        stop=["\n"],
+        guided_decoding=GuidedDecodingParams(choice=label_options) if constrained else None,
+    )
 
-    return out.strip()
+    # one call, vLLM schedules all prompts with continuous batching
+    outputs = llm.generate(prompts, sampling_params)
+
+    return [output.outputs[0].text.strip() for output in outputs]
 
 
 def main():
@@ -327,16 +486,61 @@ def main():
     parser.add_argument(
         "--cache_dir",
         type=str,
-        default="/araf/time_complexity",
+        default=None,
         help="path_to_save_model_data",
     )
+    parser.add_argument(
+        "--max-new-tokens",
+        type=int,
+        default=16,
+        help="Generation budget per example; the expected answer is a single label.",
+    )
+    parser.add_argument(
+        "--constrained",
+        action="store_true",
+        help="Restrict the output to the label set (off by default, so results stay comparable to earlier runs).",
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        choices=["none", "int8", "nf4"],
+        default="none",
+        help="Load the weights quantized with bitsandbytes (int8 is only available with --backend hf).",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the transformers model (reduce-overhead, CUDA graphs); ignored with --backend vllm.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="Number of prompts per generate call with --backend hf.",
+    )
+    parser.add_argument(
+        "--max-batch-tokens",
+        type=int,
+        default=8192,
+        help="Upper bound on padded prompt tokens per generate call with --backend hf.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["hf", "vllm"],
+        default="hf",
+        help="Inference backend: plain transformers generate, or batched vLLM.",
+    )
 
     args = parser.parse_args()
+    if args.backend == "vllm" and args.quantization == "int8":
+        parser.error("--quantization int8 is only supported with --backend hf")
 
     print("Loading dataset")
-    ds = load_tasty_dataset()
+    subset = balanced_subsample(load_tasty_dataset(args.cache_dir), n_per_class=args.num_per_class, seed=args.seed)
 
-    dataset_labels = sorted(set(ds["time_complexity"]))
+    # every label in the dataset has at least one row in the per-class sample
+    dataset_labels = sorted({row["time_complexity"] for row in subset})
     print(f"Unique time compexities: {dataset_labels}")
 
     allowed_labels = [lbl for lbl in ALL_COMPLEXITY_LABELS if lbl in dataset_labels]
@@ -344,30 +548,42 @@ def main():
         if lbl not in allowed_labels:
             allowed_labels.append(lbl)
 
-    subset = balanced_subsample(ds, n_per_class=args.num_per_class, seed=args.seed)
-
     if args.max_examples is not None and len(subset) > args.max_examples:
-        subset = subset.select(range(args.max_examples))
+        subset = subset[: args.max_examples]
 
     print(f"Total sampled examples: {len(subset)}")
 
-    print("Loading Qwen model:", args.model_name)
-    tokenizer, model = load_qwen(args.model_name, args.cache_dir)
-
-    codes = subset["code"]
-    gold_labels = subset["time_complexity"]
+    codes = [row["code"] for row in subset]
+    gold_labels = [row["time_complexity"] for row in subset]
 
     preds_raw: List[str] = []
     preds_norm: List[Optional[str]] = []
-    raw_explanation = []
 
+    print("Loading Qwen model:", args.model_name)
+    if args.backend == "vllm":
+        tokenizer, llm = load_qwen_vllm(args.model_name, args.cache_dir, args.quantization)
+
+        print("Running Qwen predictions...")
+        raw_outputs = predict_labels_vllm(
+            tokenizer, llm, codes, allowed_labels, max_new_tokens=args.max_new_tokens,
+            constrained=args.constrained,
+        )
+    else:
+        tokenizer, model = load_qwen(
+            args.model_name, args.cache_dir, args.quantization, compile_model=args.compile
+        )
 
-    print("Running Qwen predictions...")
-    for code in tqdm(codes):
-        raw = predict_label_for_example(
-            tokenizer, model, code, allowed_labels, max_new_tokens=1024
+        print("Running Qwen predictions...")
+        raw_outputs = predict_labels_batched(
+            tokenizer, model, codes, allowed_labels,
+            batch_size=args.batch_size,
+            max_batch_tokens=args.max_batch_tokens,
+            max_new_tokens=args.max_new_tokens,
+            constrained=args.constrained,
+            pad_to_multiple_of=128 if args.compile else None,
         )
-        raw_explanation.append(raw)
+
+    for raw in raw_outputs:
         norm = normalize_prediction(raw, allowed_labels)
         preds_raw.append(raw)
         # try:
@@ -377,21 +593,20 @@ def main():
         preds_norm.append(norm)
 
     # Compute accuracy
-    total = len(gold_labels)
-    correct = 0
-    unmatched = 0
+    gold_arr = np.asarray(gold_labels, dtype=str)
+    pred_arr = np.asarray([pred if pred is not None else "" for pred in preds_norm], dtype=str)
+    correct_mask = gold_arr == pred_arr
 
-    per_label_counts = defaultdict(int)
-    per_label_correct = defaultdict(int)
+    total = len(gold_arr)
+    correct = int(correct_mask.sum())
+    unmatched = int((pred_arr == "").sum())
 
-    for gold, pred in zip(gold_labels, preds_norm):
-        per_label_counts[gold] += 1
-        if pred is None:
-            unmatched += 1
-            continue
-        if pred == gold:
-            correct += 1
-            per_label_correct[gold] += 1
+    per_label_counts = {}
+    per_label_correct = {}
+    for lbl in allowed_labels:
+        label_mask = gold_arr == lbl
+        per_label_counts[lbl] = int(label_mask.sum())
+        per_label_correct[lbl] = int((correct_mask & label_mask).sum())
 
     accuracy = correct / total if total > 0 else 0.0
 
@@ -427,22 +642,22 @@ def main():
     ]
 
     with out_path.open("w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for i, (code, gold, raw, norm) in enumerate(
-            zip(codes, gold_labels, preds_raw, preds_norm)
-        ):
-            writer.writerow(
-                {
-                    "idx": i,
-                    "code": code,
-                    "gold_label": gold,
-                    "pred_raw": raw,
-                    "pred_norm": norm if norm is not None else "",
-                    "correct": int(norm == gold) if norm is not None else 0,
-                    "explanation": raw
-                }
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(
+            (
+                i,
+                code,
+                gold,
+                raw,
+                norm if norm is not None else "",
+                int(norm == gold) if norm is not None else 0,
+                raw,
             )
+            for i, (code, gold, raw, norm) in enumerate(
+                zip(codes, gold_labels, preds_raw, preds_norm)
+            )
+        )
 
     print(f"\nSaved per-example predictions to: {out_path.resolve()}")
 